@@ -35,3 +35,74 @@ TRANSFERERS = [
     tr.Hare(1711),
     tr.Gregory(),
 ]
+
+
+def test_ranked_next():
+    vote = ('A', frozenset(['B', 'C']), 'D', 'E')
+    assert tr.ranked_next(vote, 'A') == frozenset(['B', 'C'])
+    assert tr.ranked_next(vote, 'A', ['C', 'E']) == frozenset(['C'])
+    assert tr.ranked_next(vote, 'B', ['A', 'E']) == frozenset(['E'])
+    assert tr.ranked_next(vote, 'C') == frozenset(['D'])
+    assert tr.ranked_next(vote, 'E') == frozenset()
+    assert tr.ranked_next(vote, 'F') == frozenset()
+    assert tr.ranked_next(vote, 'A', ['A']) == frozenset()
+
+
+def test_ranked_next_flat():
+    vote = tuple('ABCD')
+    for cand in 'ABCDE':
+        for allowed in (None, ['A', 'D'], []):
+            assert (
+                tr.ranked_next_flat(vote, cand, allowed)
+                == tr.ranked_next(vote, cand, allowed)
+            )
+
+
+@pytest.mark.parametrize('limit_by_weight', [False, True])
+def test_distribute_n_random(limit_by_weight):
+    weights = {'A': 5, 'B': 1, 'C': 12, 'D': 3}
+    for n in range(sum(weights.values()) + 1):
+        distrib = tr.distribute_n_random(weights, n, limit_by_weight)
+        assert sum(distrib.values()) == n
+        assert all(distrib[cand] > 0 for cand in distrib)
+        # exact weights are drawn without replacement either way
+        assert all(distrib[cand] <= weights[cand] for cand in distrib)
+    assert tr.distribute_n_random({'A': 0, 'B': 0}, 0, limit_by_weight) == {}
+    with pytest.raises(ValueError):
+        tr.distribute_n_random(
+            weights, sum(weights.values()) + 1, limit_by_weight
+        )
+
+
+@pytest.mark.parametrize('transferer', TRANSFERERS)
+def test_transfer_keeps_input(transferer):
+    orig_alloc = {cand: alloc.copy() for cand, alloc in SAMPLE_ALLOC.items()}
+    new_alloc = transferer.transfer(
+        SAMPLE_ALLOC, elected={'A': 6}, eliminated=['D']
+    )
+    assert SAMPLE_ALLOC == orig_alloc
+    assert set(new_alloc.keys()) == {'B', 'C'}
+    assert new_alloc['B'][tuple('DB')] == 1
+    assert new_alloc['C'][tuple('DC')] == 1
+    with pytest.raises(KeyError):
+        transferer.transfer(SAMPLE_ALLOC, elected={'E': 6})
+
+
+def test_hare_reproducible():
+    alloc = {'A': {tuple('AB'): 7, tuple('AC'): 5, tuple('AD'): 9}, 'B': {}}
+    alloc['C'], alloc['D'] = {}, {}
+    transferer = tr.Hare(1711)
+    first = transferer.transfer(alloc, elected={'A': 10})
+    assert transferer.transfer(alloc, elected={'A': 10}) == first
+    assert tr.Hare(1711).transfer(alloc, elected={'A': 10}) == first
+    assert sum(sum(votes.values()) for votes in first.values()) == 11
+
+
+@pytest.mark.parametrize('transferer', TRANSFERERS)
+def test_transfer_shared_rank(transferer):
+    vote = ('A', frozenset(['B', 'C']), 'D', frozenset(['E', 'F']))
+    alloc = {'B': {vote: 3}, 'C': {vote: 3}, 'E': {}, 'F': {}}
+    new_alloc = transferer.transfer(alloc, eliminated=['B', 'C'])
+    assert set(new_alloc.keys()) == {'E', 'F'}
+    assert new_alloc['E'][vote] + new_alloc['F'][vote] == 6
+    assert 2 <= new_alloc['E'][vote] <= 4
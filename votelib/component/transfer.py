@@ -16,9 +16,11 @@ import collections
 import random
 import itertools
 import bisect
-import functools
 from fractions import Fraction
-from typing import Any, List, Tuple, Dict, FrozenSet, Optional, Collection
+from typing import (
+    Any, List, Tuple, Dict, FrozenSet, Optional, Collection, Iterable,
+    Sequence,
+)
 from numbers import Number
 
 from ..candidate import Candidate
@@ -40,31 +42,111 @@ def ranked_next(vote: RankedVoteType,
         last or is not present in the vote. Will only have multiple members
         if the ranked vote contains a shared rank after cand.
     '''
-    take_next = False
-    for rank_alt in vote:
+    position = _rank_position(vote, cand)
+    if position is None:
+        return frozenset()
+    for rank_alt in itertools.islice(vote, position + 1, None):
         if isinstance(rank_alt, collections.abc.Set):
-            if take_next:
-                if allowed is None:
-                    return rank_alt
-                else:
-                    allowed_alt = rank_alt.intersection(allowed)
-                    if allowed_alt:
-                        return allowed_alt
-                    # else go on for another rank
-            elif cand in rank_alt:
-                take_next = True
+            if allowed is None:
+                return rank_alt
+            allowed_alt = rank_alt.intersection(allowed)
+            if allowed_alt:
+                return allowed_alt
+            # else go on for another rank
+        elif allowed is None or rank_alt in allowed:
+            return frozenset([rank_alt])
+    return frozenset()    # exhausted ballot
+
+
+def ranked_next_flat(vote: RankedVoteType,
+                     cand: Candidate,
+                     allowed: Collection[Candidate] = None,
+                     ) -> FrozenSet[Candidate]:
+    '''Select the candidate ranked in a vote without shared ranks after cand.
+
+    A faster variant of :func:`ranked_next` for the common case of ranked
+    votes that contain no shared ranks; gives wrong results otherwise.
+
+    :param vote: The ranked vote to examine, with no shared ranks.
+    :param cand: The candidate to look after.
+    :param allowed: If specified, only return a candidate if they are in this
+        collection, otherwise continue to lower ranks.
+    :returns: The candidate ranked after cand, as a single-member frozenset.
+        Will be empty if cand was ranked last or is not present in the vote.
+    '''
+    try:
+        position = vote.index(cand)
+    except ValueError:
+        return frozenset()
+    for next_cand in itertools.islice(vote, position + 1, None):
+        if allowed is None or next_cand in allowed:
+            return frozenset([next_cand])
+    return frozenset()    # exhausted ballot
+
+
+def _rank_position(vote: RankedVoteType,
+                   cand: Candidate,
+                   ) -> Optional[int]:
+    try:
+        # fast path: the candidate occupies a rank on their own
+        return vote.index(cand)
+    except ValueError:
+        for i, rank_alt in enumerate(vote):
+            if isinstance(rank_alt, collections.abc.Set) and cand in rank_alt:
+                return i
+        return None
+
+
+def _shared_rank_types(vote: RankedVoteType) -> FrozenSet[type]:
+    # the types of the shared ranks in the vote, empty if there are none;
+    # looked up by the combination of types in the vote, which avoids a costly
+    # abstract base class check per rank
+    rank_types = frozenset(map(type, vote))
+    try:
+        return _SHARED_RANK_TYPES[rank_types]
+    except KeyError:
+        set_types = _SHARED_RANK_TYPES[rank_types] = frozenset(
+            rank_type for rank_type in rank_types
+            if issubclass(rank_type, collections.abc.Set)
+        )
+        return set_types
+
+
+# memo of _shared_rank_types(); only grows with the distinct combinations of
+# types in ranked votes, which are few
+_SHARED_RANK_TYPES = {}
+
+
+def _ranked_next_shared(vote: RankedVoteType,
+                        set_types: FrozenSet[type],
+                        cand: Candidate,
+                        allowed: FrozenSet[Candidate],
+                        ) -> FrozenSet[Candidate]:
+    # equivalent to ranked_next() for a vote with shared ranks of the given
+    # types, telling ranks apart by exact type instead of isinstance()
+    try:
+        start = vote.index(cand) + 1
+    except ValueError:
+        # the candidate is in a shared rank, or not in the vote at all
+        for start, rank_alt in enumerate(vote, start=1):
+            if type(rank_alt) in set_types and cand in rank_alt:
+                break
         else:
-            if take_next:
-                if rank_alt in allowed:
-                    return frozenset([rank_alt])
-            elif cand == rank_alt:
-                take_next = True
+            return frozenset()
+    for rank_alt in itertools.islice(vote, start, None):
+        if type(rank_alt) in set_types:
+            allowed_rank = rank_alt & allowed
+            if allowed_rank:
+                return allowed_rank
+        elif rank_alt in allowed:
+            return frozenset([rank_alt])
     return frozenset()    # exhausted ballot
 
 
 def distribute_n_random(cand_weights: Dict[Any, Number],
                         n: int,
                         limit_by_weight: bool = False,
+                        rng: Optional[random.Random] = None,
                         ) -> Dict[Any, int]:
     '''Distribute n randomly among candidates with weighted probabilities.
 
@@ -72,10 +154,31 @@ def distribute_n_random(cand_weights: Dict[Any, Number],
     :param n: Number to distribute.
     :param limit_by_weight: Whether the maximum count assigned to a candidate
         is limited by the value of their weight.
+    :param rng: Random generator to use. If not given, the functions of the
+        :mod:`random` module (with its global state) are used.
     :returns: A dictionary mapping candidates to their assigned quantities.
         The quantities sum to n.
     '''
-    candidates, weights = zip(*cand_weights.items())
+    candidates = tuple(cand_weights.keys())
+    index_selection = _distribute_n_random_indices(
+        tuple(cand_weights.values()), n, limit_by_weight, rng
+    )
+    return {candidates[ind]: count for ind, count in index_selection.items()}
+
+
+def _distribute_n_random_indices(weights: Sequence[Number],
+                                 n: int,
+                                 limit_by_weight: bool = False,
+                                 rng: Optional[random.Random] = None,
+                                 ) -> Dict[int, int]:
+    # like distribute_n_random() but for a sequence of weights, with the
+    # result keyed by their indices, so that the caller need not build a dict
+    if n == 0:
+        # nothing to draw; random.choices would reject zero total weights
+        return {}
+    if rng is None:
+        rng = random
+    draw_weights = weights
     total_weight = sum(weights)
     if isinstance(total_weight, Fraction):
         max_denom = max(
@@ -83,27 +186,45 @@ def distribute_n_random(cand_weights: Dict[Any, Number],
             for f in weights
         )
         # multiply weights by maximum denominator and then go on with integers
-        weights = [w * max_denom for w in weights]
+        draw_weights = [w * max_denom for w in weights]
         total_weight *= max_denom
     if isinstance(total_weight, int):
-        cum_weights = list(itertools.accumulate(weights))
-        generator = random.sample(range(total_weight), n)
+        # draw weight units without replacement so that no candidate can get
+        # more than their weight
+        selection = _count_sorted_draws(
+            sorted(rng.sample(range(total_weight), n)),
+            itertools.accumulate(draw_weights),
+        )
     else:
-        cum_weights = list(itertools.accumulate(
-            w / total_weight for w in weights
+        selection = collections.Counter(rng.choices(
+            range(len(weights)),
+            cum_weights=list(itertools.accumulate(draw_weights)),
+            k=n,
         ))
-        generator = (random.random() for i in range(n))
-    do_bisect = functools.partial(bisect.bisect_right, cum_weights)
-    index_selection = collections.Counter(
-        do_bisect(i) for i in generator
-    )
-    selection = {candidates[ind]: n for ind, n in index_selection.items()}
-    if limit_by_weight:
+    if limit_by_weight and any(
+        count > weights[ind] for ind, count in selection.items()
+    ):
+        # redistribute the overflow within the weight limits
         return LargestRemainder('hare').evaluate(
-            selection, n, max_seats=cand_weights
+            selection, n, max_seats=dict(enumerate(weights))
         )
     else:
-        return selection
+        return dict(selection)
+
+
+def _count_sorted_draws(draws: List[int],
+                        cum_weights: Iterable[int],
+                        ) -> Dict[int, int]:
+    # counts the draws falling into each cumulative weight interval with one
+    # bisection per interval instead of one per draw
+    counts = {}
+    lower = 0
+    for ind, cum_weight in enumerate(cum_weights):
+        upper = bisect.bisect_left(draws, cum_weight, lower)
+        if upper > lower:
+            counts[ind] = upper - lower
+        lower = upper
+    return counts
 
 
 class VoteTransferer(metaclass=abc.ABCMeta):
@@ -135,6 +256,11 @@ class VoteTransferer(metaclass=abc.ABCMeta):
 
 
 class SimpleVoteTransferer(VoteTransferer):
+    def __init__(self):
+        # types of shared ranks in each ranked vote, kept across the counts
+        # of an election so that every vote is classified only once
+        self._shared_ranks = {}
+
     def transfer(self,
                  allocation: Dict[Candidate, Dict[RankedVoteType, Number]],
                  elected: Dict[Candidate, Number] = {},
@@ -152,15 +278,40 @@ class SimpleVoteTransferer(VoteTransferer):
         :param eliminated: Candidates eliminated from the contest without being
             elected. Their votes will be transferred to next candidates on the
             ballots.
+        :returns: The new allocation. The input allocation is not modified;
+            votes of candidates that received no transfers are shared with it.
         '''
-        allocation = {cand: alloc.copy() for cand, alloc in allocation.items()}
-        if elected:
-            for cand, quota in elected.items():
-                self._subtract(allocation[cand], quota)
+        for cand in elected:
+            if cand not in allocation:
+                # the quota of an elected candidate must be subtracted
+                raise KeyError(cand)
         to_retain, to_remove = self._select(allocation, elected, eliminated)
+        # votes of retained candidates are only copied once they receive
+        # transfers, the rest is shared with the input allocation
+        result = {
+            cand: alloc for cand, alloc in allocation.items()
+            if cand in to_retain
+        }
+        copied = set()
+        shared_ranks = self._shared_ranks
+        if len(shared_ranks) > 2 * sum(map(len, allocation.values())):
+            # mostly votes of earlier counts or elections, start over
+            shared_ranks.clear()
         for cand in to_remove:
-            for vote, n_votes in allocation[cand].items():
-                targets = ranked_next(vote, cand, to_retain)
+            if cand in elected:
+                transferred = self._surplus(allocation[cand], elected[cand])
+            else:
+                transferred = allocation[cand].items()
+            for vote, n_votes in transferred:
+                set_types = shared_ranks.get(vote)
+                if set_types is None:
+                    set_types = shared_ranks[vote] = _shared_rank_types(vote)
+                if set_types:
+                    targets = _ranked_next_shared(
+                        vote, set_types, cand, to_retain
+                    )
+                else:
+                    targets = ranked_next_flat(vote, cand, to_retain)
                 if targets:
                     if len(targets) > 1:
                         realloc = self._distribute_equal_ranking(
@@ -170,23 +321,26 @@ class SimpleVoteTransferer(VoteTransferer):
                         target, = targets
                         realloc = {target: n_votes}
                     for target, n in realloc.items():
-                        target_alloc = allocation.setdefault(target, {})
-                        if vote not in target_alloc:
-                            target_alloc[vote] = 0
-                        target_alloc[vote] += n
-            del allocation[cand]
-        return allocation
+                        if target not in copied:
+                            result[target] = result[target].copy()
+                            copied.add(target)
+                        target_alloc = result[target]
+                        target_alloc[vote] = target_alloc.get(vote, 0) + n
+        return result
 
     @staticmethod
     def _select(allocation: Dict[Candidate, Dict[RankedVoteType, Number]],
                 elected: Dict[Candidate, Number] = {},
                 eliminated: List[Candidate] = [],
-                ) -> Tuple[List[Candidate], List[Candidate]]:
-        may_remove = list(elected.keys()) + eliminated
+                ) -> Tuple[FrozenSet[Candidate], List[Candidate]]:
+        may_remove = set(elected.keys()).union(eliminated)
         to_retain, to_remove = [], []
         for cand in allocation:
             (to_remove if cand in may_remove else to_retain).append(cand)
-        return to_retain, to_remove
+        # transfer the largest allocations first, while the target
+        # allocations are still small
+        to_remove.sort(key=lambda cand: len(allocation[cand]), reverse=True)
+        return frozenset(to_retain), to_remove
 
 
 class Hare(SimpleVoteTransferer):
@@ -207,19 +361,33 @@ class Hare(SimpleVoteTransferer):
     def __init__(self,
                  seed: Optional[int] = None,
                  ):
+        super().__init__()
         self.seed = seed
         self.stable = (self.seed is not None)
+        self._rng = random.Random(seed)
 
-    def _subtract(self,
-                  cand_alloc: Dict[RankedVoteType, Number],
-                  quota: int,
-                  ) -> None:
-        random.seed(self.seed)
-        subtractions = distribute_n_random(
-            cand_alloc, quota, limit_by_weight=True
+    def transfer(self,
+                 allocation: Dict[Candidate, Dict[RankedVoteType, Number]],
+                 elected: Dict[Candidate, Number] = {},
+                 eliminated: List[Candidate] = [],
+                 ) -> Dict[Candidate, Dict[RankedVoteType, Number]]:
+        # reseed once per transfer so that results are reproducible
+        self._rng.seed(self.seed)
+        return super().transfer(allocation, elected, eliminated)
+
+    def _surplus(self,
+                 cand_alloc: Dict[RankedVoteType, Number],
+                 quota: int,
+                 ) -> Iterable[Tuple[RankedVoteType, Number]]:
+        # the ballots to discard must all be drawn before any is transferred
+        votes = tuple(cand_alloc.keys())
+        surplus = list(cand_alloc.values())
+        subtractions = _distribute_n_random_indices(
+            surplus, quota, limit_by_weight=True, rng=self._rng
         )
-        for vote, num in subtractions.items():
-            cand_alloc[vote] -= num
+        for ind, num in subtractions.items():
+            surplus[ind] -= num
+        return zip(votes, surplus)
 
     def _distribute_equal_ranking(self,
                                   targets: FrozenSet[Candidate],
@@ -234,13 +402,10 @@ class Hare(SimpleVoteTransferer):
         else:
             result = {}
             remainder = n_votes
-        random.seed(self.seed)
-        remnant_dist = distribute_n_random(
-            {tgt: remainder for tgt in targets},
-            remainder,
-        )
-        for cand, transfer in remnant_dist.items():
-            result[cand] = result.get(cand, 0) + transfer
+        # the remainder is smaller than the number of targets, so give one
+        # more vote to each of that many targets picked uniformly at random
+        for cand in self._rng.sample(list(targets), remainder):
+            result[cand] = result.get(cand, 0) + 1
         return result
 
 
@@ -261,18 +426,27 @@ class Gregory(SimpleVoteTransferer):
     The implementation produces exact fractional votes. Rounding rules are not
     implemented yet.
     '''
-    def _subtract(self,
-                  cand_alloc: Dict[RankedVoteType, Fraction],
-                  quota: Fraction,
-                  ) -> None:
+    def _surplus(self,
+                 cand_alloc: Dict[RankedVoteType, Fraction],
+                 quota: Fraction,
+                 ) -> Iterable[Tuple[RankedVoteType, Fraction]]:
         current_sum = sum(cand_alloc.values())
         fraction = Fraction(current_sum - quota, current_sum)
-        for vote in cand_alloc.keys():
-            cand_alloc[vote] *= fraction
+        # build the products directly from integer parts, which is much
+        # cheaper than dispatching Fraction.__mul__ for every vote;
+        # yielded lazily so that they are transferred in the same pass
+        mul_num, mul_den = fraction.numerator, fraction.denominator
+        for vote, n_votes in cand_alloc.items():
+            yield vote, Fraction(
+                n_votes.numerator * mul_num,
+                n_votes.denominator * mul_den,
+            )
 
     def _distribute_equal_ranking(self,
                                   targets: FrozenSet[Candidate],
                                   n_votes: Fraction,
                                   ) -> Dict[Candidate, Fraction]:
-        split_val = Fraction(n_votes, len(targets))
+        split_val = Fraction(
+            n_votes.numerator, n_votes.denominator * len(targets)
+        )
         return {cand: split_val for cand in targets}